@@ -0,0 +1,407 @@
+import datetime
+from functools import lru_cache, partial
+from typing import Callable, Dict, List, Tuple, Union
+
+import numpy as np
+from scipy.optimize import brentq, minimize_scalar
+from sgp4.api import Satrec, SatrecArray, jday
+
+# WGS84 ellipsoid
+WGS84_A = 6378.137  # equatorial radius in km
+WGS84_F = 1 / 298.257223563
+WGS84_E2 = WGS84_F * (2 - WGS84_F)
+
+PassWindow = Tuple[datetime.datetime, datetime.datetime, datetime.datetime]
+
+
+def get_next_passes(tles: Dict[str, Tuple[str, str]],
+                    locations: dict,
+                    utc_time: datetime.datetime,
+                    length: int,
+                    horizon: float = 0.0,
+                    step: float = 60.0,
+                    fine_step: float = 1.0,
+                    sites: Dict[str, Tuple[np.ndarray, np.ndarray]] = None
+                    ) -> Dict[str, Dict[str, List[PassWindow]]]:
+    """ Find the passes of every satellite over every location
+
+    All satellites are propagated in one batched SGP4 call on a coarse time
+    grid, and the elevation above each location is computed for the whole
+    (satellite, time) array at once. Only the brackets around horizon
+    crossings and culminations are resampled finely, and each resampled
+    bracket is propagated once and shared by all locations.
+
+    :param tles: TLE lines as (line1, line2) for each satellite name
+    :param locations: Locations with lat, lon (degrees) and alt (km) attributes
+    :param utc_time: Start of the search window
+    :param length: Length of the search window in hours
+    :param horizon: Elevation in degrees a satellite must exceed
+    :param step: Sampling interval of the time grid in seconds
+    :param fine_step: Sampling interval in seconds used to refine each pass
+    :param sites: Precomputed site_cache of the locations
+    :return: [(rise-time, fall-time, max-elevation-time), ...] for each
+        satellite and location, following pyorbital's get_next_passes
+    """
+    names = list(tles)
+    satrecs = [make_satrec(*tles[name]) for name in names]
+    sat_array = SatrecArray(satrecs)
+
+    offsets, jd, fr = _time_grid(utc_time, length, step)
+    if not len(offsets):
+        # an empty search window has no passes, as in pyorbital
+        return {name: {loc: [] for loc in locations} for name in names}
+    err, r, _ = sat_array.sgp4(jd, fr)
+    r_ecef = _teme_to_ecef(r, _gmst(jd, fr))
+
+    if sites is None:
+        sites = site_cache(locations)
+
+    # earth fixed positions of each satellite on the fine grid of the coarse
+    # intervals that were resampled, shared between the locations
+    tracks = [
+        partial(_fine_track, satrec, jd[0], fr[0], offsets, fine_step, dict())
+        for satrec in satrecs
+    ]
+
+    passes = {name: dict() for name in names}
+    for loc in locations:
+        _, el = observer_look(r_ecef, *sites[loc])
+        # samples where SGP4 failed are treated as below the horizon
+        el = np.where(err == 0, el, -90.0) - horizon
+
+        # horizon crossings of all satellites in one pass over the array,
+        # split into one run of time indices per satellite
+        sat_idx, time_idx = _crossings(el)
+        bounds = np.searchsorted(sat_idx, np.arange(1, len(names)))
+        for i, (name, crossings) in enumerate(zip(names, np.split(time_idx, bounds))):
+            elevation = partial(_elevation, satrecs[i], *sites[loc],
+                                jd[0], fr[0], horizon)
+            fine_elevation = partial(_fine_elevation, tracks[i], *sites[loc],
+                                     horizon)
+            passes[name][loc] = _find_passes(
+                utc_time, offsets, el[i], crossings, elevation,
+                fine_elevation, fine_step)
+
+    return passes
+
+
+@lru_cache(maxsize=64)
+def make_satrec(line1: str, line2: str) -> Satrec:
+    """ Parse a TLE into an SGP4 satellite record, reusing earlier results
+
+    :param line1: First line of the TLE
+    :param line2: Second line of the TLE
+    :return: SGP4 satellite record
+    """
+    return Satrec.twoline2rv(line1, line2)
+
+
+def site_cache(locations: dict) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """ Compute the earth fixed site of every location once
+
+    :param locations: Locations with lat, lon (degrees) and alt (km) attributes
+    :return: site_ecef result for each location
+    """
+    return {
+        loc: site_ecef(locations[loc].lat, locations[loc].lon, locations[loc].alt)
+        for loc in locations
+    }
+
+
+def _time_grid(utc_time: datetime.datetime,
+               length: int,
+               step: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ Build a regular time grid as split julian dates
+
+    :param utc_time: Start of the grid
+    :param length: Length of the grid in hours
+    :param step: Sampling interval in seconds
+    :return: Offsets from utc_time in seconds, julian day and day fraction
+    """
+    jd0, fr0 = jday(utc_time.year, utc_time.month, utc_time.day,
+                    utc_time.hour, utc_time.minute,
+                    utc_time.second + utc_time.microsecond * 1e-6)
+    offsets = np.arange(0.0, length * 3600.0, step)
+    fr = fr0 + offsets / 86400.0
+    jd = np.full_like(fr, jd0)
+    return offsets, jd, fr
+
+
+def _gmst(jd: np.ndarray, fr: np.ndarray) -> np.ndarray:
+    """ Greenwich mean sidereal time (IAU-82), as used by SGP4
+
+    :param jd: Julian day
+    :param fr: Fraction of day
+    :return: GMST in radians
+    """
+    tut1 = (jd - 2451545.0 + fr) / 36525.0
+    seconds = (-6.2e-6 * tut1 ** 3 + 0.093104 * tut1 ** 2 +
+               (876600.0 * 3600.0 + 8640184.812866) * tut1 + 67310.54841)
+    return np.deg2rad(seconds / 240.0) % (2 * np.pi)
+
+
+def _teme_to_ecef(r: np.ndarray, theta: np.ndarray) -> np.ndarray:
+    """ Rotate TEME positions into the earth fixed frame (polar motion ignored)
+
+    :param r: Positions in km with shape (..., n_time, 3)
+    :param theta: GMST in radians with shape (n_time,)
+    :return: Earth fixed positions in km with the shape of r
+    """
+    cos_theta = np.cos(theta)
+    sin_theta = np.sin(theta)
+    x = cos_theta * r[..., 0] + sin_theta * r[..., 1]
+    y = -sin_theta * r[..., 0] + cos_theta * r[..., 1]
+    return np.stack((x, y, r[..., 2]), axis=-1)
+
+
+def site_ecef(lat: float, lon: float, alt: float) -> Tuple[np.ndarray, np.ndarray]:
+    """ Earth fixed position and local east-north-up frame of a location
+
+    :param lat: Geodetic latitude of the location in degrees
+    :param lon: Longitude of the location in degrees
+    :param alt: Altitude of the location in km
+    :return: Position in km and the rotation matrix from earth fixed to ENU
+    """
+    lat = np.deg2rad(lat)
+    lon = np.deg2rad(lon)
+    sin_lat, cos_lat = np.sin(lat), np.cos(lat)
+    sin_lon, cos_lon = np.sin(lon), np.cos(lon)
+
+    n = WGS84_A / np.sqrt(1 - WGS84_E2 * sin_lat ** 2)
+    position = np.array([(n + alt) * cos_lat * cos_lon,
+                         (n + alt) * cos_lat * sin_lon,
+                         (n * (1 - WGS84_E2) + alt) * sin_lat])
+    enu = np.array([[-sin_lon, cos_lon, 0.0],
+                    [-sin_lat * cos_lon, -sin_lat * sin_lon, cos_lat],
+                    [cos_lat * cos_lon, cos_lat * sin_lon, sin_lat]])
+    return position, enu
+
+
+def observer_look(r_ecef: np.ndarray,
+                  position: np.ndarray,
+                  enu: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """ Azimuth and elevation of earth fixed positions seen from a location
+
+    :param r_ecef: Earth fixed positions in km with shape (..., 3)
+    :param position: Earth fixed position of the location, see site_ecef
+    :param enu: Rotation from earth fixed to ENU at the location, see site_ecef
+    :return: Azimuth and elevation in degrees
+    """
+    topo = (r_ecef - position) @ enu.T
+    rng = np.linalg.norm(topo, axis=-1)
+    az = np.rad2deg(np.arctan2(topo[..., 0], topo[..., 1])) % 360.0
+    el = np.rad2deg(np.arcsin(np.clip(topo[..., 2] / rng, -1.0, 1.0)))
+    return az, el
+
+
+def get_observer_look(satrec: Satrec,
+                      utc_times: np.ndarray,
+                      position: np.ndarray,
+                      enu: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """ Azimuth and elevation of a satellite seen from a location
+
+    :param satrec: SGP4 satellite record
+    :param utc_times: Times to compute the look angles for
+    :param position: Earth fixed position of the location, see site_ecef
+    :param enu: Rotation from earth fixed to ENU at the location, see site_ecef
+    :return: Azimuth and elevation in degrees for each time
+    """
+    return observer_look(_propagate_ecef(satrec, utc_times), position, enu)
+
+
+def get_sub_satellite_lon(satrec: Satrec, utc_times: np.ndarray) -> np.ndarray:
+    """ Longitude of the sub-satellite point
+
+    :param satrec: SGP4 satellite record
+    :param utc_times: Times to compute the longitude for
+    :return: Longitude in degrees in [-180, 180) for each time
+    """
+    r_ecef = _propagate_ecef(satrec, utc_times)
+    return np.rad2deg(np.arctan2(r_ecef[..., 1], r_ecef[..., 0]))
+
+
+def _propagate_ecef(satrec: Satrec, utc_times: np.ndarray) -> np.ndarray:
+    """ Earth fixed positions of one satellite at arbitrary times
+
+    :param satrec: SGP4 satellite record
+    :param utc_times: Times as datetimes or datetime64
+    :return: Earth fixed positions in km with shape (n_time, 3)
+    """
+    jd, fr = _julian_dates(utc_times)
+    _, r, _ = satrec.sgp4_array(jd, fr)
+    return _teme_to_ecef(r, _gmst(jd, fr))
+
+
+def _julian_dates(utc_times: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """ Split julian dates of arbitrary times, relative to J2000
+
+    :param utc_times: Times as datetimes or datetime64
+    :return: Julian day and day fraction
+    """
+    days = (np.asarray(utc_times, dtype="datetime64[us]") -
+            np.datetime64("2000-01-01T12:00")) / np.timedelta64(1, "D")
+    return np.full_like(days, 2451545.0), days
+
+
+def _crossings(el: np.ndarray) -> Tuple[np.ndarray, ...]:
+    """ Find the samples after which the elevation crosses the horizon
+
+    The above-horizon mask is compared with itself shifted by one sample
+    using a branchless XOR on uint8, along the last axis.
+
+    :param el: Elevation above the horizon in degrees, time along the last axis
+    :return: Indices of the samples before each crossing, as from np.nonzero
+    """
+    above = (el > 0).view(np.uint8)
+    return np.nonzero(above[..., :-1] ^ above[..., 1:])
+
+
+def _elevation(satrec: Satrec,
+               position: np.ndarray,
+               enu: np.ndarray,
+               jd: float,
+               fr: float,
+               horizon: float,
+               offset: Union[float, np.ndarray]) -> Union[float, np.ndarray]:
+    """ Elevation above the horizon of one satellite at one or more times
+
+    :param satrec: SGP4 satellite record
+    :param position: Earth fixed position of the location, see site_ecef
+    :param enu: Rotation from earth fixed to ENU at the location, see site_ecef
+    :param jd: Julian day of the start of the time grid
+    :param fr: Fraction of day of the start of the time grid
+    :param horizon: Elevation of the horizon in degrees
+    :param offset: Time or array of times in seconds after the start of the time grid
+    :return: Elevation above the horizon in degrees, with the shape of offset
+    """
+    if np.ndim(offset) == 0:
+        fr = fr + offset / 86400.0
+        err, r, _ = satrec.sgp4(jd, fr)
+        if err != 0:
+            return -90.0 - horizon
+        r_ecef = _teme_to_ecef(np.array(r), _gmst(jd, fr))
+        return float(observer_look(r_ecef, position, enu)[1]) - horizon
+
+    fr = fr + np.asarray(offset) / 86400.0
+    jd = np.full_like(fr, jd)
+    err, r, _ = satrec.sgp4_array(jd, fr)
+    _, el = observer_look(_teme_to_ecef(r, _gmst(jd, fr)), position, enu)
+    return np.where(err == 0, el, -90.0) - horizon
+
+
+def _fine_track(satrec: Satrec,
+                jd: float,
+                fr: float,
+                offsets: np.ndarray,
+                fine_step: float,
+                cache: dict,
+                i: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ Earth fixed positions of one satellite on the fine grid of a coarse interval
+
+    The fine grid only depends on the time grid, so it is propagated once
+    and kept in cache for the other locations.
+
+    :param satrec: SGP4 satellite record
+    :param jd: Julian day of the start of the time grid
+    :param fr: Fraction of day of the start of the time grid
+    :param offsets: Coarse sample times in seconds after the start of the time grid
+    :param fine_step: Sampling interval in seconds of the fine grid
+    :param cache: Fine grids already propagated, by coarse interval
+    :param i: Index of the coarse sample starting the interval
+    :return: Fine sample times in seconds after the start of the time grid,
+        earth fixed positions in km and SGP4 error codes
+    """
+    if i not in cache:
+        fine = np.arange(offsets[i], offsets[i + 1] + fine_step / 2, fine_step)
+        frs = fr + fine / 86400.0
+        jds = np.full_like(frs, jd)
+        err, r, _ = satrec.sgp4_array(jds, frs)
+        cache[i] = fine, _teme_to_ecef(r, _gmst(jds, frs)), err
+    return cache[i]
+
+
+def _fine_elevation(track: Callable,
+                    position: np.ndarray,
+                    enu: np.ndarray,
+                    horizon: float,
+                    i: int) -> Tuple[np.ndarray, np.ndarray]:
+    """ Elevation above the horizon on the fine grid of a coarse interval
+
+    :param track: Fine grid positions of a coarse interval, see _fine_track
+    :param position: Earth fixed position of the location, see site_ecef
+    :param enu: Rotation from earth fixed to ENU at the location, see site_ecef
+    :param horizon: Elevation of the horizon in degrees
+    :param i: Index of the coarse sample starting the interval
+    :return: Fine sample times in seconds after the start of the time grid and
+        the elevation above the horizon in degrees at each of them
+    """
+    fine, r_ecef, err = track(i)
+    _, el = observer_look(r_ecef, position, enu)
+    return fine, np.where(err == 0, el, -90.0) - horizon
+
+
+def _find_passes(utc_time: datetime.datetime,
+                 offsets: np.ndarray,
+                 el: np.ndarray,
+                 crossings: np.ndarray,
+                 elevation: Callable,
+                 fine_elevation: Callable,
+                 fine_step: float = 1.0,
+                 tol: float = 0.001) -> List[PassWindow]:
+    """ Locate complete passes in a sampled elevation series
+
+    Each coarse bracket is first resampled at fine_step. Rise and fall are
+    then found with Brent's method inside the bracketing
+    fine samples, and the time of maximum elevation with a bounded Brent
+    minimisation around the highest fine sample. Passes that are already in
+    progress at the start or still in progress at the end of the series are
+    skipped.
+
+    :param utc_time: Time of the first sample
+    :param offsets: Sample times in seconds after utc_time
+    :param el: Elevation above the horizon in degrees for each sample
+    :param crossings: Indices of the samples before each horizon crossing
+    :param elevation: Elevation above the horizon at a time, or an array of
+        times, in seconds after utc_time
+    :param fine_elevation: Fine sample times and elevations above the horizon
+        of the coarse interval starting at a sample, see _fine_elevation
+    :param fine_step: Sampling interval in seconds of the refinement grid
+    :param tol: Precision of the result in seconds
+    :return: [(rise-time, fall-time, max-elevation-time), ...]
+    """
+    res = []
+    rise = None
+    for i in crossings:
+        lo, hi = offsets[i], offsets[i + 1]
+        fine, fine_el = fine_elevation(i)
+        changes, = _crossings(fine_el)
+        if len(changes):
+            lo, hi = fine[changes[0]], fine[changes[0] + 1]
+        crossing = brentq(elevation, lo, hi, xtol=tol)
+        if el[i + 1] > 0:
+            rise, rise_idx = crossing, i
+            continue
+        if rise is None:
+            continue
+
+        # highest fine sample of the pass within a coarse step of the
+        # highest coarse sample
+        middle = rise_idx + 1 + np.argmax(el[rise_idx + 1:i + 1])
+        before, before_el = fine_elevation(middle - 1)
+        after, after_el = fine_elevation(middle)
+        fine = np.concatenate((before, after[1:]))
+        fine_el = np.concatenate((before_el, after_el[1:]))
+        inside = (fine >= rise) & (fine <= crossing)
+        peak = fine[inside][np.argmax(fine_el[inside])]
+        highest = minimize_scalar(
+            lambda t: -elevation(t),
+            bounds=(max(rise, peak - fine_step),
+                    min(crossing, peak + fine_step)),
+            method="bounded",
+            options={"xatol": tol}).x
+
+        res.append((utc_time + datetime.timedelta(seconds=float(rise)),
+                    utc_time + datetime.timedelta(seconds=float(crossing)),
+                    utc_time + datetime.timedelta(seconds=float(highest))))
+        rise = None
+    return res
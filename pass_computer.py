@@ -1,77 +1,294 @@
-from datetime import datetime
-from pyorbital.orbital import Orbital
+import csv
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Optional, Union
 import requests
-from weather.ccmet import CCMET
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import requests_cache
+from weather.ccmet import CCMET, get_forecast_cached
+from orbit.passes import get_next_passes, get_observer_look, get_sub_satellite_lon, make_satrec, site_cache
+from pyorbital import astronomy
+from sgp4.api import Satrec
+import orjson
 import os
-import pypandoc
+import html
+import statistics
 import numpy as np
+import pandas as pd
 
 # Debug flag
 DEBUG = False
 VERBOSE = False
 
+# celestrak.org endpoint for a single TLE, formatted with the NORAD catalog number
+TLE_URL = "https://celestrak.org/NORAD/elements/gp.php?CATNR={catnr}&FORMAT=TLE"
+
+# celestrak only refreshes TLEs a few times per day, so responses are reused
+# from an on-disk cache for an hour
+TLE_CACHE = "tle/http_cache"
+TLE_CACHE_EXPIRY = 3600
+
+# last collected TLEs, reused while their epoch is recent enough. The file is
+# kept out of git, until the first download the TLEs in TLE_SEED_FILE are used
+TLE_FILE = "tle/tle_cache.json"
+TLE_SEED_FILE = "tle/satellites.json"
+
+# locations to find passes over
+LOCATIONS_FILE = "locations.csv"
+
+# offsets in degrees of the rows and columns of the cloud cover grid
+GRID_STEPS = np.array([-0.05, 0.0, 0.05])
+
 file_dir = os.path.dirname(os.path.realpath(__file__))
 
 # set dir of file to current working directory
 os.chdir(file_dir)
 
+
+@dataclass(slots=True)
+class Pass:
+    """
+    A pass of a satellite over a location, at the time of max elevation
+    """
+    utc_time: datetime
+    azimuth: float
+    elevation: float
+    sun_zenith_angle: float
+    cloud_cover: float
+    satellite: str = ""
+    location: str = ""
+
+
+@dataclass(slots=True)
+class Satellite:
+    """
+    A satellite with its TLE and the passes found for each location
+    """
+    catnr: int
+    line1: str
+    line2: str
+    min_elev: Optional[Union[float, str]] = None
+    passes: dict = field(default_factory=dict)
+
+
+@dataclass(slots=True, frozen=True)
+class Location:
+    """
+    A location on the ground, lat and lon in degrees and alt in km
+    """
+    lat: float
+    lon: float
+    alt: float
+
+
 # Satellites as dict
 satellites = {
-    "HYPSO-1": {"catnr": 51053, "line1": "Line1", "line2": "Line2", "min_elev": 40},
-    "Sentinel-3A": {"catnr": 41335, "line1": "Line1", "line2": "Line2", "min_elev": "Depends on location"},
-    "Sentinel-3B": {"catnr": 43437, "line1": "Line1", "line2": "Line2", "min_elev": "Depends on location"},
-    "SENTINEL-2A": {"catnr": 40697, "line1": "Line1", "line2": "Line2", "min_elev": 90 - 10},
-    "SENTINEL-2B": {"catnr": 42063, "line1": "Line1", "line2": "Line2", "min_elev": 90 - 10},
+    "HYPSO-1": Satellite(51053, "Line1", "Line2", 40),
+    "Sentinel-3A": Satellite(41335, "Line1", "Line2", "Depends on location"),
+    "Sentinel-3B": Satellite(43437, "Line1", "Line2", "Depends on location"),
+    "SENTINEL-2A": Satellite(40697, "Line1", "Line2", 90 - 10),
+    "SENTINEL-2B": Satellite(42063, "Line1", "Line2", 90 - 10),
 }
 
-# Locations as dict
-locations = {
-    "Mjøsa": {"lat": 60.70, "lon": 10.98, "alt": 0.0},
-    "Tyrifjorden": {"lat": 60.03, "lon": 10.18, "alt": 0.0},
-    "Hemnessjøen": {"lat": 59.68, "lon": 11.46, "alt": 0.0},
-    "Vansjø": {"lat": 59.40, "lon": 10.82, "alt": 0.0},
-    "Gjersjøen": {"lat": 59.79, "lon": 10.78, "alt": 0.0},
-    "Solbergstrand": {"lat": 59.620, "lon": 10.650, "alt": 0.0},
-    "Eikeren": {"lat": 59.6591812, "lon": 9.9289544, "alt": 0.0},
-    "Bergsvannet": {"lat": 59.5757441, "lon": 10.0689287, "alt": 0.0},
-    "Akersvannet": {"lat": 59.24417, "lon": 10.32762, "alt": 0.0},
-    "Skulerudsjøen": {"lat": 59.66426, "lon": 11.54688, "alt": 0.0},
-    "Rødenessjøen": {"lat": 59.56363, "lon": 11.60278, "alt": 0.0},
-    "Aremarksjøen": {"lat": 59.2606265, "lon": 11.6740797, "alt": 0.0},
-    "Femsjøen": {"lat": 59.15268, "lon": 11.49769, "alt": 0.0},
-    "Øyeren": {"lat": 59.69713, "lon": 11.23023, "alt": 0.0},
-    "Årungen": {"lat": 59.683, "lon": 10.733, "alt": 0.0},
-    "Tunevatnet": {"lat": 59.305, "lon": 11.093, "alt": 0.0},
-    "Østensjøvannet": {"lat": 59.689, "lon": 10.829, "alt": 0.0},
-    "Øymarksjøen": {"lat": 59.38921, "lon": 11.65738, "alt": 0.0},
-    "Lundebyvatnet": {"lat": 59.550, "lon": 11.480, "alt": 0.0},
-    "Solbergstrand": {"lat": 59.620, "lon": 10.650, "alt": 0.0},
-    "Glomma-Løperen": {"lat": 59.170, "lon": 10.960, "alt": 0.0},
-}
 
+def load_locations(path: str) -> dict:
+    """
+    Reads the locations from a csv file with the columns name, lat, lon and alt
+
+    Args:
+        path (str): path to the csv file
+
+    Returns:
+        dict: dict of Location objects, in the order of the file
+    """
+    locations = dict()
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            if row["name"] in locations:
+                raise ValueError(f"Location {row['name']} is listed twice in {path}")
+            locations[row["name"]] = Location(
+                float(row["lat"]), float(row["lon"]), float(row["alt"]))
+    return locations
+
+
+# Locations as dict, read from the csv file LOCATIONS_FILE
+locations = load_locations(LOCATIONS_FILE)
+
+
+def _tle_session(pool_size: int) -> requests_cache.CachedSession:
+    """
+    Creates a keep-alive session with room for one pooled connection per worker
+
+    Responses are stored in a SQLite cache keyed by URL (and thus by CATNR),
+    so repeated runs within TLE_CACHE_EXPIRY seconds never touch the network.
+    Transient failures and rate limiting are retried with exponential backoff.
+
+    Args:
+        pool_size (int): number of connections kept alive towards celestrak.org
+
+    Returns:
+        requests_cache.CachedSession: session to share between the download threads
+    """
+    session = requests_cache.CachedSession(
+        TLE_CACHE,
+        backend="sqlite",
+        expire_after=TLE_CACHE_EXPIRY
+    )
+    retries = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504]
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=pool_size,
+        max_retries=retries
+    )
+    session.mount("https://", adapter)
+    return session
+
+
+def tle_epoch(line1: str) -> datetime:
+    """
+    Parses the epoch of a TLE
+
+    Args:
+        line1 (str): first line of the TLE
+
+    Returns:
+        datetime: epoch of the TLE in UTC
+    """
+    year = int(line1[18:20])
+    year += 2000 if year < 57 else 1900
+    return datetime(year, 1, 1) + timedelta(days=float(line1[20:32]) - 1)
+
+
+def _load_TLE_cache() -> dict:
+    """
+    Reads the last collected TLEs from TLE_FILE, or from TLE_SEED_FILE if
+    nothing has been collected yet
+
+    Returns:
+        dict: dict of satellites with TLEs, empty if there is no cache
+    """
+    for path in (TLE_FILE, TLE_SEED_FILE):
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                return orjson.loads(f.read())
+    return dict()
+
+
+def _cached_TLE(tle_cache: dict, satellite: str, catnr: int) -> Optional[dict]:
+    """
+    Looks up a satellite in the TLE cache
+
+    Args:
+        tle_cache (dict): dict of satellites with TLEs as read from TLE_FILE
+        satellite (str): satellite name
+        catnr (int): NORAD catalog number the cached TLE must belong to
+
+    Returns:
+        Optional[dict]: cached TLE, None if there is none for this satellite
+    """
+    cached = tle_cache.get(satellite)
+    if cached is None or cached['catnr'] != catnr:
+        return None
+    return cached
 
-def collect_TLEs(satellites: dict) -> dict:
+
+def _save_TLE_cache(tle_cache: dict) -> None:
+    """
+    Writes the collected TLEs to TLE_FILE
+
+    Args:
+        tle_cache (dict): dict of satellites with TLEs
+    """
+    with open(TLE_FILE, "wb") as f:
+        f.write(orjson.dumps(tle_cache, option=orjson.OPT_INDENT_2))
+
+
+def collect_TLEs(
+        satellites: dict,
+        max_workers: int = 8,
+        max_age_hours: float = 6.0) -> dict:
     """
     Collects TLEs from celestrak.org and updates the TLEs in the satellites dict
 
+    TLEs in TLE_FILE with an epoch less than max_age_hours old are reused
+    without touching the network. The remaining requests are issued
+    concurrently over a single keep-alive session, so the total wall time is
+    roughly one round trip instead of one per satellite. If a download fails
+    the TLE in TLE_FILE is used regardless of its age.
+
     Args:
-        satellites (dict): dict of satellites with TLEs to be updated
+        satellites (dict): dict of Satellite objects with TLEs to be updated
+        max_workers (int, optional): number of concurrent downloads. Defaults to 8.
+        max_age_hours (float, optional): maximum age of a cached TLE epoch in hours. Defaults to 6.0.
 
     Returns:
         dict: dict of satellites with updated TLEs
     """
-    try:
-        for satellite in satellites:
+    tle_cache = _load_TLE_cache()
+    now = datetime.utcnow()
+
+    urls = dict()
+    for satellite in satellites:
+        cached = _cached_TLE(tle_cache, satellite, satellites[satellite].catnr)
+        if cached is not None and \
+                (now - tle_epoch(cached['line1'])).total_seconds() < max_age_hours * 3600:
             if DEBUG or VERBOSE:
-                print(f"collecting TLE for {satellite}")
-            url = f"https://celestrak.org/NORAD/elements/gp.php?CATNR={satellites[satellite]['catnr']}&FORMAT=TLE"
-            tle = requests.get(url)
-            tle = tle.text.splitlines()
-            satellites[satellite]['line1'] = tle[1]
-            satellites[satellite]['line2'] = tle[2]
-    except BaseException:
-        print('Error. TLE Update not successful')
+                print(f"using cached TLE for {satellite}")
+            satellites[satellite].line1 = cached['line1']
+            satellites[satellite].line2 = cached['line2']
+        else:
+            urls[satellite] = TLE_URL.format(catnr=satellites[satellite].catnr)
+
+    if not urls:
+        return satellites
+
+    updated = set()
+    with _tle_session(max_workers) as session, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(session.get, url, timeout=10): satellite
+            for satellite, url in urls.items()
+        }
+        for future in as_completed(futures):
+            satellite = futures[future]
+            # a failed download must not take the rest of the batch with it
+            try:
+                response = future.result()
+                response.raise_for_status()
+            except requests.RequestException as e:
+                print(f'Error. TLE Update not successful for {satellite}: {e}')
+                continue
+            tle = response.text.splitlines()
+            if len(tle) < 3:
+                print(f'Error. No TLE received for {satellite}')
+                continue
+            if DEBUG or VERBOSE:
+                print(f"collected TLE for {satellite}")
+            satellites[satellite].line1 = tle[1]
+            satellites[satellite].line2 = tle[2]
+            tle_cache[satellite] = {
+                'catnr': satellites[satellite].catnr,
+                'line1': tle[1],
+                'line2': tle[2],
+            }
+            updated.add(satellite)
+
+    # fall back to the last collected TLE for failed downloads
+    for satellite in urls:
+        cached = _cached_TLE(tle_cache, satellite, satellites[satellite].catnr)
+        if satellite not in updated and cached is not None:
+            print(f'Using stored TLE from {tle_epoch(cached["line1"])} for {satellite}')
+            satellites[satellite].line1 = cached['line1']
+            satellites[satellite].line2 = cached['line2']
+
+    if updated:
+        _save_TLE_cache(tle_cache)
     return satellites
 
 
@@ -79,109 +296,174 @@ def compute_passes(
         satellites: dict,
         locations: dict,
         look_ahead_time: int = 24 * 3,
-        minimumElevation: float = 40) -> dict:
+        minimumElevation: float = 40,
+        utc_time: Optional[datetime] = None) -> dict:
     """
     Computes passes for each satellite at each location
 
     Args:
         satellites (dict): dict of satellites with TLEs
-        locations (dict): dict of locations
+        locations (dict): dict of Location objects
         look_ahead_time (int, optional): look ahead time in hours. Defaults to 24*3.
         minimumElevation (float, optional): minimum elevation in degrees. Defaults to 40.
+        utc_time (Optional[datetime], optional): start of the search window. Defaults to now.
 
     Returns:
         dict: dict of satellites with passes for each location
     """
+    # one reference time for all satellites and locations
+    now = datetime.utcnow() if utc_time is None else utc_time
+
+    # Find the passes of all satellites over all locations in one batch
+    tles = {
+        satellite: (satellites[satellite].line1, satellites[satellite].line2)
+        for satellite in satellites
+    }
+    sites = site_cache(locations)
+    next_passes = get_next_passes(
+        tles,
+        locations,
+        now,
+        look_ahead_time,
+        horizon=int(minimumElevation // 1),
+        sites=sites
+    )
+
+    # met.no forecasts of the grid around each location, fetched once here
+    # and shared by all satellites
+    if DEBUG:
+        forecasts = {loc: None for loc in locations}
+    else:
+        forecasts = _grid_forecasts(locations)
+
+    # After the batched search only a few array operations per pass are
+    # left, so the pass info is computed in this process
     for satellite in satellites:
-        # Get orbital object from pyorbital using the TLEs
-        sat_obj = Orbital(
-            satellite,
-            line1=satellites[satellite]['line1'],
-            line2=satellites[satellite]['line2']
+        # Get SGP4 satellite record using the TLEs
+        satrec = make_satrec(
+            satellites[satellite].line1,
+            satellites[satellite].line2
         )
 
-        satellites[satellite]['passes'] = dict()
-        # Get next passes for each location
+        satellites[satellite].passes = dict()
         for loc in locations:
-            loc_info = sat_obj.get_next_passes(
-                datetime.utcnow(),
-                look_ahead_time,
-                locations[loc]['lon'],
-                locations[loc]['lat'],
-                locations[loc]['alt'],
-                tol=0.001,
-                horizon=int(minimumElevation // 1)
-            )
-
             # extract max elevation datetime and compute elevation
-            pass_info = get_pass_info_list(locations, sat_obj, loc, loc_info)
-            satellites[satellite]['passes'][loc] = pass_info
+            satellites[satellite].passes[loc] = get_pass_info_list(
+                locations, satrec, loc, next_passes[satellite][loc],
+                sites[loc], forecasts[loc])
 
     return satellites
 
 
+def _grid_forecasts(locations: dict, max_workers: int = 8) -> dict:
+    """
+    Fetches the forecasts of a grid of .05 degree around each location
+
+    The requests for all grid points of all locations are submitted at
+    once and run up to max_workers at a time.
+
+    Args:
+        locations (dict): dict of Location objects
+        max_workers (int, optional): number of concurrent downloads. Defaults to 8.
+
+    Returns:
+        dict: forecast of each grid point, for each location
+    """
+    points = {loc: _grid_points(locations[loc]) for loc in locations}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # submit every request before waiting for any of them
+        futures = {
+            loc: [executor.submit(get_forecast_cached, lat, lon)
+                  for lat, lon in zip(lats, lons)]
+            for loc, (lats, lons) in points.items()
+        }
+        return {
+            loc: [future.result() for future in loc_futures]
+            for loc, loc_futures in futures.items()
+        }
+
+
+def _grid_points(loc_info: Location) -> tuple:
+    """
+    Computes a grid of .05 degree around a location
+
+    Args:
+        loc_info (Location): the location
+
+    Returns:
+        tuple: lists of the latitudes and longitudes of the grid points
+    """
+    lats, lons = np.broadcast_arrays(
+        loc_info.lat + GRID_STEPS[:, None],
+        loc_info.lon + GRID_STEPS[None, :])
+    return lats.ravel().tolist(), lons.ravel().tolist()
+
+
 def get_pass_info_list(
         locations: dict,
-        sat_obj: Orbital,
+        satrec: Satrec,
         loc: str,
-        loc_info: list
+        loc_info: list,
+        site: tuple,
+        forecasts: Optional[list] = None
 ) -> list:
     """
     Extracts max elevation datetime and computes elevation for each pass
 
     Args:
-        locations (dict): dict of locations
-        sat_obj (Orbital): pyorbital orbital object
+        locations (dict): dict of Location objects
+        satrec (Satrec): SGP4 satellite record
         loc (str): location
         loc_info (list): list of passes
+        site (tuple): earth fixed position and ENU rotation of the location
+        forecasts (Optional[list], optional): forecasts of the grid around the location. Fetched if not given.
 
     Returns:
-        list: list of passes with max elevation datetime and elevation
+        list: list of Pass objects with max elevation datetime and elevation
     """
-    from pyorbital.orbital import astronomy
-
     pass_info = []
-    for i in range(len(loc_info)):
-        pass_info.append(dict())
+    if not loc_info:
+        return pass_info
 
-        pass_info[i]["UTC0_datetime"] = loc_info[i][2].strftime(
-            "%Y-%m-%d %H:%M:%SZ")
+    # look angles at max elevation for all passes in one call
+    tca_datetimes = [max_elev_time for _, _, max_elev_time in loc_info]
+    tca_times = np.array(tca_datetimes, dtype="datetime64[us]")
+    azimuths, elevations = get_observer_look(satrec, tca_times, *site)
 
-        temp_obj = sat_obj.get_observer_look(loc_info[i][2],
-                                             locations[loc]["lon"],
-                                             locations[loc]["lat"],
-                                             locations[loc]["alt"])
+    # reduce to two decimals
+    azimuths = np.round(azimuths, 2).tolist()
+    elevations = np.round(elevations, 2).tolist()
 
-        # reduce to two decimals
-        temp_obj = [round(temp_obj[0], 2), round(temp_obj[1], 2)]
+    # check sun zenith angle for all passes in one call
+    sun_zenith_angles = astronomy.sun_zenith_angle(
+        tca_times, locations[loc].lon, locations[loc].lat).tolist()
 
-        pass_info[i]["azimuth"] = temp_obj[0]
-        pass_info[i]["elevation"] = temp_obj[1]
-
-        # check sun zenith angle
-        pass_info[i]["sun_zenith_angle"] = astronomy.sun_zenith_angle(
-            loc_info[i][2], locations[loc]["lon"], locations[loc]["lat"])
+    if DEBUG:
+        cloud_cover = [-1] * len(loc_info)
+    else:
+        # Get the cloud cover of every pass for each point of the grid
+        # around the location from its forecast
+        if forecasts is None:
+            forecasts = _grid_forecasts({loc: locations[loc]})[loc]
+        grid_cloud_cover = [
+            [CCMET.from_forecast(data, t).get_cloud_cover() for t in tca_datetimes]
+            for data in forecasts
+        ]
+        # compute median cloud cover of the grid points for each pass
+        cloud_cover = [float(statistics.median(vals)) for vals in zip(*grid_cloud_cover)]
+
+    for max_elev_time, azimuth, elevation, sun_zenith_angle, cc in zip(
+            tca_datetimes, azimuths, elevations, sun_zenith_angles, cloud_cover):
+        pass_info.append(Pass(
+            utc_time=max_elev_time,
+            azimuth=azimuth,
+            elevation=elevation,
+            sun_zenith_angle=sun_zenith_angle,
+            cloud_cover=cc,
+            location=loc))
 
-        if DEBUG:
-            pass_info[i]["cloud_cover"] = -1
-        # elif pass_info[i]["sun_zenith_angle"] > 70:
-        #     pass_info[i]["cloud_cover"] = 101
-        else:
-            # Make a grid of .05 degree around the location and compute cloud
-            # cover for each point.
-            median_cloud_cover = []
-            for lat_steps in range(-1, 2):
-                for lon_steps in range(-1, 2):
-                    CCMET_obj = CCMET(
-                        locations[loc]["lat"] + lat_steps * 0.05,
-                        locations[loc]["lon"] + lon_steps * 0.05,
-                        loc_info[i][2])
-                    median_cloud_cover.append(CCMET_obj.get_cloud_cover())
-            # compute median cloud cover
-            pass_info[i]["cloud_cover"] = np.median(median_cloud_cover)
         if VERBOSE:
-            print(
-                f"cloud cover for {loc} at {pass_info[i]['UTC0_datetime']} is {pass_info[i]['cloud_cover']}")
+            print(f"cloud cover for {loc} at {max_elev_time.strftime('%Y-%m-%d %H:%M:%SZ')} is {cc}")
     return pass_info
 
 
@@ -193,113 +475,143 @@ def date_table_generator(satellites_passes: dict,
     Generates a date table from the passes
 
     Args:
-        satellites_passes (dict): dict of satellites with passes for each location
+        satellites_passes (dict): dict of Satellite objects with passes for each location
         min_elev (float, optional): minimum elevation in degrees. Defaults to 40.0.
         max_clouds (float, optional): maximum cloud cover in percent. Defaults to 100.0.
         min_solarelevation (float, optional): minimum solar elevation in degrees. Defaults to 10.0.
 
     Returns:
-        dict: dict of dates with passes
+        dict: dict of dates with Pass objects, both in chronological order
     """
-    from pyorbital.orbital import astronomy
+    # flatten all passes into one frame, keeping the Pass objects as a column
+    passes = []
+    for satellite in satellites_passes:
+        for loc_passes in satellites_passes[satellite].passes.values():
+            for pass_obj in loc_passes:
+                pass_obj.satellite = satellite
+                passes.append(pass_obj)
+    if not passes:
+        return dict()
+    df = pd.DataFrame({
+        "pass": passes,
+        "satellite": [p.satellite for p in passes],
+        "location": [p.location for p in passes],
+        "utc_time": [p.utc_time for p in passes],
+        "elevation": [p.elevation for p in passes],
+        "sun_zenith_angle": [p.sun_zenith_angle for p in passes],
+        "cloud_cover": [p.cloud_cover for p in passes],
+    })
+
+    utc_times = pd.to_datetime(df["utc_time"])
+    lons = df["location"].map(lambda loc: locations[loc].lon)
+
+    # the sun zenith angle was computed with the pass info, so the solar
+    # elevation follows directly from it
+    solarelev = 90 - df["sun_zenith_angle"]
+
+    too_low = solarelev < min_solarelevation
+    for idx in df.index[too_low]:
+        print(
+            f"Sun elevation angle for {df.at[idx, 'satellite']} at {df.at[idx, 'utc_time'].strftime('%Y-%m-%d %H:%M:%SZ')} is {solarelev[idx]}, too low")
+    df, utc_times, lons = df[~too_low], utc_times[~too_low], lons[~too_low]
+
+    # use the min_elev of the satellite if it is set
+    min_elevs = df["satellite"].map(
+        lambda satellite: min_elev if satellites_passes[satellite].min_elev is None
+        else satellites_passes[satellite].min_elev)
+
+    # if "Sentinel-3" in satellite compensate for the fact that
+    # the 68.5 degree swath field of view is not centred at nadir,
+    # but is tilted 12.6 degrees westwards
+    for satellite in df["satellite"].unique():
+        if "Sentinel-3" not in satellite or satellites_passes[satellite].min_elev is None:
+            continue
+        rows = df["satellite"] == satellite
+        satrec = make_satrec(
+            satellites_passes[satellite].line1,
+            satellites_passes[satellite].line2
+        )
+        sat_lon = get_sub_satellite_lon(satrec, utc_times[rows].values)
 
-    min_elev_static = min_elev
+        # check if target is west of the satellite
+        min_elevs[rows] = np.where(sat_lon > lons[rows].values,
+                                   45,  # geogebra simulation
+                                   69)  # geogebra simulation
 
-    date_table = dict()
-    for satellite in satellites_passes:
-        for loc in satellites_passes[satellite]["passes"]:
-            for pass_list in satellites_passes[satellite]["passes"][loc]:
-                # check sun zenith angle
-                sza = astronomy.sun_zenith_angle(pass_list["UTC0_datetime"],
-                                                 locations[loc]["lon"],
-                                                 locations[loc]["lat"])
-                
-                # compute solare elevation
-                solarelev = 90 - sza
-
-                if solarelev < min_solarelevation:
-                    print(
-                        f"Sun elevation angle for {satellite} at {pass_list['UTC0_datetime']} is {solarelev}, too low")
-                    continue
-
-                # check if min_elev key exists in satellite dict
-                if "min_elev" in satellites_passes[satellite]:
-                    min_elev = satellites_passes[satellite]["min_elev"]
-                    # if "Sentinel-3" in satellite compensate for the fact that
-                    # the 68.5 degree swath field of view is not centred at nadir, 
-                    # but is tilted 12.6 degrees westwards
-                    if "Sentinel-3" in satellite:
-                        sat_obj_temp = Orbital(
-                            satellite,
-                            line1=satellites[satellite]['line1'],
-                            line2=satellites[satellite]['line2']
-                        )
-                        sat_pos = sat_obj_temp.get_position(
-                            pass_list["UTC0_datetime"])
-                        sat_lon = sat_pos[0][0]
-
-                        # check if target is west of the satellite
-                        if sat_lon > locations[loc]["lon"]:
-                            min_elev = 45 # geogebra simulation
-                        else:
-                            min_elev = 69 # geogebra simulation
-                else:
-                    min_elev = min_elev_static
-
-                if VERBOSE:
-                    print(
-                        f"min_elev for {satellite} at {pass_list['UTC0_datetime']} is {min_elev}")
-
-                if pass_list["elevation"] >= min_elev and pass_list["cloud_cover"] <= max_clouds:
-                    # get the date as a string
-                    date = pass_list["UTC0_datetime"].split(" ")[0]
-                    if date not in date_table:
-                        date_table[date] = []
-                    dict_obj = pass_list
-                    dict_obj["satellite"] = satellite
-                    dict_obj["location"] = loc
-                    date_table[date].append(dict_obj)
+    if VERBOSE:
+        for idx in df.index:
+            print(
+                f"min_elev for {df.at[idx, 'satellite']} at {df.at[idx, 'utc_time'].strftime('%Y-%m-%d %H:%M:%SZ')} is {min_elevs[idx]}")
+
+    keep = (df["elevation"] >= min_elevs) & (df["cloud_cover"] <= max_clouds)
+    df = df[keep]
+
+    # group the passes by date, with dates and the passes of each date in
+    # chronological order
+    order = utc_times[keep].sort_values(kind="stable").index
+    dates = utc_times[order].dt.date
+    date_table = {
+        date: group["pass"].tolist()
+        for date, group in df.loc[order].groupby(dates, sort=True)
+    }
 
     return date_table
 
 
-def date_table_to_markdown(date_table: dict, locations: dict) -> str:
-    """ Generates a markdown table from the date table
+def date_table_to_html(date_table: dict, locations: dict) -> str:
+    """ Generates a html table for each date of the date table
+
+    Args:
+        date_table (dict): dict of dates with Pass objects in chronological order
+        locations (dict): dict of Location objects
+
+    Returns:
+        str: html headings and tables
+    """
+    # location column labels are the same for every pass
+    loc_lat_lon = {
+        loc: f"{loc} ({locations[loc].lat}, {locations[loc].lon})"
+        for loc in locations
+    }
+
+    parts = []
+    for date, passes in date_table.items():
+        parts.append(f'<h2 class="subtitle" >{date}</h2>\n')
+        parts.append(html_table(
+            ["Satellite", "Location", "UTC+0", "Elevation", "Cloud Cover"],
+            [
+                (pass_info.satellite,
+                 loc_lat_lon[pass_info.location],
+                 pass_info.utc_time.strftime('%H:%M:%SZ'),
+                 pass_info.elevation,
+                 pass_info.cloud_cover)
+                for pass_info in passes
+            ]))
+    return "".join(parts)
+
+
+def html_table(header: list, rows: list) -> str:
+    """ Generates a centred html table styled for the page
 
     Args:
-        date_table (dict): dict of dates with passes
-        locations (dict): dict of locations with lat, lon and alt
+        header (list): column names
+        rows (list): values of each row, in the order of the columns
 
     Returns:
-        str: markdown table
-    """
-    return_str = ""
-
-    entries = []
-    for date in date_table.keys():
-        passes = date_table[date]
-        passes.sort(key=lambda x: x["UTC0_datetime"])
-        entry = ""
-        for i in range(len(passes)):
-            pass_info = passes[i]
-            clock_time = pass_info["UTC0_datetime"].split(" ")[1]
-            lat_temp = locations[pass_info["location"]]["lat"]
-            lon_temp = locations[pass_info["location"]]["lon"]
-            loc_lat_lon = pass_info["location"] + f" ({lat_temp}, {lon_temp})"
-            entry += f"{pass_info['satellite']} | {loc_lat_lon} | {clock_time} | {pass_info['elevation']} | {pass_info['cloud_cover']}\n"
-
-        entries.append([date, entry])
-
-    # concatenate all entries in the correct order
-    sorted_entries = sorted(entries, key=lambda x: x[0])
-    return_str = ""
-    for entry in sorted_entries:
-        return_str += f"## {entry[0]}\n"
-        return_str += "Satellite | Location | UTC+0 | Elevation | Cloud Cover\n"
-        return_str += "--- | --- | --- | --- | --- | ---\n"
-        return_str += entry[1]
-    return_str += "\n\n"
-    return return_str
+        str: html table
+    """
+    parts = [
+        "<table class='table' width=\"750px\" style=\"margin-left: auto; margin-right: auto;\">\n",
+        "<thead>\n<tr>\n",
+    ]
+    parts.extend(f'  <th align="center">{html.escape(str(name))}</th>\n' for name in header)
+    parts.append("</tr>\n</thead>\n<tbody>\n")
+    for row in rows:
+        parts.append("<tr>\n")
+        parts.extend(f'  <td align="center">{html.escape(str(value))}</td>\n' for value in row)
+        parts.append("</tr>\n")
+    parts.append("</tbody>\n</table>\n")
+    return "".join(parts)
 
 
 def _get_cli_args():
@@ -370,23 +682,19 @@ if __name__ == "__main__":
         VERBOSE = True
         print("Verbose mode activated")
 
-    if not DEBUG:
-        satellites = collect_TLEs(satellites)  # Update TLEs
-    elif DEBUG and os.path.isfile("tle/satellites.json"):
-        with open("tle/satellites.json", "r") as f:
-            satellites = json.load(f)
+    # Update TLEs, in debug mode any cached TLE is good enough
+    if DEBUG:
+        satellites = collect_TLEs(satellites, max_age_hours=float("inf"))
     else:
         satellites = collect_TLEs(satellites)
-        with open("tle/satellites.json", "w") as f:
-            json.dump(satellites, f, indent=1)
-    
+
     if VERBOSE:
         print("TLEs collected")
-        # format json string with indent of 1
-        print(json.dumps(satellites, indent=1))
+        # format json string with indent of 2
+        print(orjson.dumps(satellites, option=orjson.OPT_INDENT_2).decode())
 
     satellites_passes = compute_passes(
-        satellites, locations, args.look_ahead_hrs, args.minelev)
+        satellites, locations, args.look_ahead_hrs, args.minelev, start_time)
 
     date_table = date_table_generator(
         satellites_passes, 
@@ -396,70 +704,56 @@ if __name__ == "__main__":
     
     if VERBOSE:
         print("Date table generated")
-        # format json string with indent of 1
-        print(json.dumps(date_table, indent=1))
-
-    markdown_str = "# Satellite Forecaster\n\n"
-
-    # write some info about what the script does to the markdown file
-    markdown_str += "This website contains a forecast of satellite passes for the next week. " + \
-        "At the bottom of the site you can see the different satellites and the different locations" + \
-        " that are used in the forecast. The forecast is generated using the pyorbital library. " + \
-        "The forecast is generated for the next week and is updated every day. " + \
-        "The cloud cover is retrieved from the Norwegian Meteorological Institute. " + \
-        "The cloud cover is given as the median of a grid at the location."
-    markdown_str += "The forecast is generated using the following parameters:\n\n"
-    markdown_str += f"Maximum cloud cover: {args.maxclouds} percent\n\n"
-    markdown_str += f"Look ahead time: {args.look_ahead_hrs} hours\n\n"
-    markdown_str += f" \n\n"
+        # format json string with indent of 2
+        print(orjson.dumps(
+            date_table,
+            option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        ).decode())
+
+    html_parts = ['<h1 class="title" >Satellite Forecaster</h1>\n']
+
+    # write some info about what the script does to the page
+    html_parts.append(
+        "<p>This website contains a forecast of satellite passes for the next week. " +
+        "At the bottom of the site you can see the different satellites and the different locations" +
+        " that are used in the forecast. The passes are computed with SGP4 from the latest TLEs. " +
+        "The forecast is generated for the next week and is updated every day. " +
+        "The cloud cover is retrieved from the Norwegian Meteorological Institute. " +
+        "The cloud cover is given as the median of a grid at the location." +
+        "The forecast is generated using the following parameters:</p>\n")
+    html_parts.append(f"<p>Maximum cloud cover: {args.maxclouds} percent</p>\n")
+    html_parts.append(f"<p>Look ahead time: {args.look_ahead_hrs} hours</p>\n")
     script_time = datetime.utcnow() - start_time
     # with two decimals in seconds
     script_time = round(script_time.total_seconds(), 2)
-    markdown_str += f"Time to complete script (seconds): {script_time}\n\n"
+    html_parts.append(f"<p>Time to complete script (seconds): {script_time}</p>\n")
 
-    markdown_str += date_table_to_markdown(date_table, locations)
+    html_parts.append(date_table_to_html(date_table, locations))
 
     # add table of locations
-    markdown_str += "## Locations\n\n"
-    markdown_str += "Location | Latitude | Longitude | Altitude\n"
-    markdown_str += "--- | --- | --- | ---\n"
-    for loc in locations:
-        l0 = locations[loc]["lat"]
-        l1 = locations[loc]["lon"]
-        l2 = locations[loc]["alt"]
-        markdown_str += f"{loc} | {l0} | {l1} | {l2}\n"
+    html_parts.append('<h2 class="subtitle" >Locations</h2>\n')
+    html_parts.append(html_table(
+        ["Location", "Latitude", "Longitude", "Altitude"],
+        [(loc, locations[loc].lat, locations[loc].lon, locations[loc].alt)
+         for loc in locations]))
 
     # add table of satellites
-    markdown_str += "\n\n## Satellites\n\n"
-    markdown_str += "Satellite | NORAD ID | Minimum Elevation\n"
-    markdown_str += "--- | --- | ---\n"
-    for sat in satellites:
-        sat_name = sat
-        norad_id = satellites[sat]["catnr"]
-        min_elev = satellites[sat]["min_elev"]
-        markdown_str += f"{sat_name} | {norad_id} | {min_elev}\n"
-
-    # convert markdown to html
-    output = "<!DOCTYPE html>\n<html>\n<head>\n<meta charset=\"utf-8\">\n</head>\n<body>\n"
-    output += '<link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/bulma@0.9.4/css/bulma.min.css">\n'
-    output += "<div style=\"width: 800px; margin-left: auto; margin-right: auto;\">\n"
-    pdoc_args = ['--mathjax']
-    output += pypandoc.convert_text(markdown_str,
-                                    'html5',
-                                    format='md',
-                                    extra_args=pdoc_args,
-                                    encoding='utf-8')
-    output += "</div>"
-    output += "\n</body>\n</html>"
-
-    output = output.replace(
-        "<table>",
-        "<table class='table' width=\"750px\" style=\"margin-left: auto; margin-right: auto;\">")
-    # make all table elements center
-    output = output.replace("<td>", "<td align=\"center\">")
-    output = output.replace("<th>", "<th align=\"center\">")
-    output = output.replace("<h1", "<h1 class=\"title\" ")
-    output = output.replace("<h2", "<h2 class=\"subtitle\" ")
+    html_parts.append('<h2 class="subtitle" >Satellites</h2>\n')
+    html_parts.append(html_table(
+        ["Satellite", "NORAD ID", "Minimum Elevation"],
+        [(sat, satellites[sat].catnr, satellites[sat].min_elev)
+         for sat in satellites]))
+
+    # the tables are written as html directly, so only the page around
+    # them is left to add
+    output = "".join([
+        "<!DOCTYPE html>\n<html>\n<head>\n<meta charset=\"utf-8\">\n</head>\n<body>\n",
+        '<link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/bulma@0.9.4/css/bulma.min.css">\n',
+        "<div style=\"width: 800px; margin-left: auto; margin-right: auto;\">\n",
+        *html_parts,
+        "</div>",
+        "\n</body>\n</html>",
+    ])
 
     with open("index.html", "w") as f:
         f.write(output)
@@ -1,24 +1,44 @@
+import bisect
 import datetime
+import functools
 import logging
 import requests
-from typing import Dict
+import requests_cache
+import threading
+from requests.adapters import HTTPAdapter
+from typing import Dict, List, Optional
+
+# Forecasts are kept in an on-disk cache for as long as the Expires header
+# of met.no allows, so repeated runs do not download them again. Expired
+# forecasts are revalidated with If-Modified-Since, which met.no answers
+# with 304 if nothing changed.
+FORECAST_CACHE = "weather/http_cache"
+FORECAST_CACHE_EXPIRY = 3600
+
+# session shared by all forecast requests, see _session
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
 
 
 class CCMET(object):
     """ Class for getting weather data from the yr.no API
     """
 
-    def __init__(self, lat: float, lon: float, time: datetime.datetime) -> None:
+    def __init__(self, lat: float, lon: float, time: datetime.datetime, data: Optional[dict] = None) -> None:
         """ Initialize the class
 
         :param lat: Latitude of the location
         :param lon: Longitude of the location
         :param time: Time to get the forecast for
+        :param data: Forecast data as returned by get_forecast, fetched if not given
         """
         self.lat = lat
         self.lon = lon
         self.time = time
-        r = get_forecast_at_time(self.lat, self.lon, self.time)
+        if data is None:
+            r = get_forecast_at_time(self.lat, self.lon, self.time)
+        else:
+            r = _closest_forecast(data, self.time)
 
         self.air_pressure_at_sea_level = r["air_pressure_at_sea_level"]
         self.air_temperature = r["air_temperature"]
@@ -30,6 +50,17 @@ class CCMET(object):
     def get_cloud_cover(self) -> float:
         return self.cloud_area_fraction
 
+    @classmethod
+    def from_forecast(cls, data: dict, time: datetime.datetime) -> "CCMET":
+        """ Pick the weather at a time from an already fetched forecast
+
+        :param data: Forecast data as returned by get_forecast
+        :param time: Time to get the forecast for
+        :return: Weather at the closest available time
+        """
+        lon, lat = data["geometry"]["coordinates"][:2]
+        return cls(lat, lon, time, data=data)
+
 
 def get_forecast_at_time(lat: float, lon: float, time: datetime.datetime) -> Dict[str, float]:
     """ Get the forecast at a specific time
@@ -39,20 +70,87 @@ def get_forecast_at_time(lat: float, lon: float, time: datetime.datetime) -> Dic
     :param time: Time to get the forecast for
     :return: Forecast data as a dict for the closest available time
     """
-    data = get_forecast(lat, lon)
-    time_diff = abs(datetime.datetime(1970, 1, 1, 0, 0, 0, 0) - time)
-    best_time = None
-    for obj in data["properties"]["timeseries"]:
-        obj_time = datetime.datetime.fromisoformat(obj["time"][:-1])
-        if abs(time - obj_time) < time_diff:
-            time_diff = abs(time - obj_time)
-            best_time = obj
-
-    r = best_time["data"]["instant"]["details"]
+    return _closest_forecast(get_forecast_cached(lat, lon), time)
+
+
+def _closest_forecast(data: dict, time: datetime.datetime) -> Dict[str, float]:
+    """ Pick the forecast closest to a specific time
+
+    :param data: Forecast data as returned by get_forecast
+    :param time: Time to get the forecast for
+    :return: Forecast data as a dict for the closest available time
+    """
+    series = data["properties"]["timeseries"]
+    times = _forecast_times(data)
+
+    # the series is sorted by time, so the closest forecast is one of the
+    # two neighbours of the insertion point
+    i = bisect.bisect_left(times, time)
+    if i == len(times) or (i > 0 and time - times[i - 1] <= times[i] - time):
+        i -= 1
+    best_time = series[i]
+
+    r = dict(best_time["data"]["instant"]["details"])
     r["time"] = best_time["time"]
     return r
 
 
+def _forecast_times(data: dict) -> List[datetime.datetime]:
+    """ Get the parsed times of a forecast, parsed once and kept in the forecast
+
+    :param data: Forecast data as returned by get_forecast
+    :return: Time of each entry of the forecast timeseries
+    """
+    times = data.get("_times")
+    if times is None:
+        times = [datetime.datetime.fromisoformat(obj["time"][:-1])
+                 for obj in data["properties"]["timeseries"]]
+        data["_times"] = times
+    return times
+
+
+def get_forecast_cached(lat: float, lon: float) -> Dict[str, float]:
+    """ Get the forecast for a specific location, fetched once per process
+
+    The coordinates are rounded to 4 decimals, the precision met.no uses,
+    so nearby requests for the same point share one download.
+
+    :param lat: Latitude of the location
+    :param lon: Longitude of the location
+    :return: Forecast data as a dict, shared between callers
+    """
+    return _forecast_cached(round(lat, 4), round(lon, 4))
+
+
+@functools.lru_cache(maxsize=None)
+def _forecast_cached(lat_r: float, lon_r: float) -> Dict[str, float]:
+    return get_forecast(lat_r, lon_r)
+
+
+def _session() -> requests_cache.CachedSession:
+    """ Keep-alive session shared by all forecast requests, created on first use
+
+    The connection to api.met.no is only set up once, and responses are
+    stored in FORECAST_CACHE. Creation is guarded by a lock, as the first
+    requests come from several threads at once.
+
+    :return: Session to send the forecast requests with
+    """
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            _SESSION = requests_cache.CachedSession(
+                FORECAST_CACHE,
+                backend="sqlite",
+                cache_control=True,
+                expire_after=FORECAST_CACHE_EXPIRY
+            )
+            _SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+            _SESSION.headers.update({
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/102.0.0.0 Safari/537.36'})
+    return _SESSION
+
+
 def get_forecast(lat: float, lon: float) -> Dict[str, float]:
     """ Get the forecast for a specific location
 
@@ -61,11 +159,9 @@ def get_forecast(lat: float, lon: float) -> Dict[str, float]:
     :return: Forecast data as a dict
     """
     url = f"https://api.met.no/weatherapi/locationforecast/2.0/compact?lat={lat}&lon={lon}"
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/102.0.0.0 Safari/537.36'}
 
     try:
-        r = requests.get(url.strip(), headers=headers, timeout=10)
+        r = _session().get(url.strip(), timeout=10)
         r.raise_for_status()
     except requests.exceptions.RequestException as e:
         logging.error(f"Error getting forecast: {e}")